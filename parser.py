@@ -1,8 +1,18 @@
 import argparse
+import functools
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 from pathlib import Path
-from typing import Dict
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
 import json
 
+logger = logging.getLogger(__name__)
+
 class LogFormat:
     """Represents the format of a FMT message"""
 
@@ -29,12 +39,22 @@ class LogFormat:
         "Q": "uint64_t"
     }
 
+    # FORMAT flattened into a list indexed by the ASCII code of the format character
+    _FMT_TABLE = [None] * 128
+    for _char, _dt_type in FORMAT.items():
+        _FMT_TABLE[ord(_char)] = _dt_type
+    del _char, _dt_type
+
     def __init__(self, type: int, length: int, name: str, format: str, column_string: str) -> None:
         self.type = int(type)
         self.length = int(length)
-        self.name = str(name)
-        self.columns = str(column_string).split(',')
-        self.format = self.__extract_data_format(str(format), self.columns)
+        # names and columns (TimeUS, ...) repeat across formats and are used as dict keys
+        self.name = sys.intern(str(name))
+        self.columns = [sys.intern(c) for c in str(column_string).split(',')]
+        self.expected_columns = len(self.columns)
+        # the column -> data type dict and the data type of each column, in column order.
+        # Both are shared between identical FMT messages and must not be modified
+        self.format, self.datatypes = _extract_data_format(str(format), tuple(self.columns))
 
     def get_expected_column_count(self) -> int:
         """Get the expected number of columns
@@ -42,20 +62,7 @@ class LogFormat:
         Returns:
             int: number of columns
         """
-        return len(self.columns)
-
-    def __extract_data_format(self, format_string: str, columns: list) -> dict:
-        format_dict = dict()
-        for index, char in enumerate(format_string):
-            dt_type = self.FORMAT.get(char, None)
-
-            if dt_type is None:
-                raise ValueError(f'Unknown data type in column: {char}')
-
-            c = columns[index]
-            format_dict[c] = dt_type
-
-        return format_dict
+        return self.expected_columns
 
     def __str__(self) -> str:
         return f"Name: {self.name}; Length: {self.length}; Column and Format: {self.format}"
@@ -64,134 +71,442 @@ class LogFormat:
         return str(self)
 
 
+@functools.lru_cache(maxsize=256)
+def _extract_data_format(format_string: str, columns: Tuple[str, ...]) -> Tuple[Dict[str, str], Tuple[str, ...]]:
+    # cached as logs can repeat the same FMT messages, e.g. logs concatenated across reboots
+    format_dict = dict()
+    datatypes = list()
+    fmt_table = LogFormat._FMT_TABLE
+    for index, char in enumerate(format_string):
+        code = ord(char)
+        dt_type = fmt_table[code] if code < 128 else None
+
+        if dt_type is None:
+            raise ValueError(f'Unknown data type in column: {char}')
+
+        c = columns[index]
+        format_dict[c] = dt_type
+        datatypes.append(dt_type)
+
+    return format_dict, tuple(datatypes)
+
+
 class OutputFile:
-    """Output file object to write the data to a csv / json file"""
+    """Output file object to stream the data to a csv file and write the json datatype file"""
+
+    # separator of the fields of a log line
+    SEPARATOR = b', '
+    # number of rows to collect before writing them to the file
+    _BATCH = 1024
 
-    def __init__(self, columns: list, file_name: Path, datatypes: list) -> None:
+    def __init__(self, columns: list, file_name: str, datatypes: tuple, header: bool = True) -> None:
+        """Initialize the OutputFile object
+
+        Args:
+            columns (list): column names, shared with the LogFormat and not modified
+            file_name (str): csv file path, ending in .csv
+            datatypes (tuple): data type of each column, shared with the LogFormat
+            header (bool, optional): write the header and the json datatype file. A shard
+                of a csv written by a worker process has neither. Defaults to True.
+        """
         self.columns = columns
         self.file_name = file_name
         self.datatypes = datatypes
-        self.data = list()
+        self.header = header
+        # map the columns to the datatypes for the json datatype file
+        self._schema = dict(zip(self.columns, self.datatypes))
+        # a data line with n columns has n separators, one after the message name and
+        # n - 1 between the columns. A line without any separator has no columns
+        self._expected_separators = len(columns)
+
+        # the csv file is only opened when the first rows are written, so message types
+        # that are never logged don't hold a file handle or produce any file
+        self._fh: Optional[BinaryIO] = None
+        self._pending: List[bytes] = list()
 
-    def add_data(self, data: list):
-        """Add data to the output file
+    def add_data(self, line: bytes):
+        """Write the row of a data line to the output file
 
         Args:
-            data (list): csv row for the output file
+            line (bytes): stripped data line, the message name followed by the fields,
+                all separated by ", "
+
+        Raises:
+            ValueError: if the row does not have the number of columns the output file was
+                created with. A message type can't be redefined with other columns, the FMT
+                pass rejects that, so this is also the format of the message type
+        """
+        separators = line.count(self.SEPARATOR)
+        if separators != self._expected_separators:
+            raise ValueError(f'Expected {self._expected_separators} columns, got {separators}')
+        self._pending.append(line.partition(self.SEPARATOR)[2].replace(self.SEPARATOR, b','))
+        if len(self._pending) >= self._BATCH:
+            self.flush()
+
+    def get_row_writer(self) -> Tuple[int, Callable[[bytes], None]]:
+        """Get what the parse loop needs to add rows without calling add_data
+
+        Returns:
+            Tuple[int, Callable[[bytes], None]]: number of SEPARATOR in a valid data line, the
+                same count add_data checks, and the function adding the fields of the line with
+                the separators already replaced by ",". The rows added this way are only
+                written by flush(), which has to be called regularly
         """
-        self.data.append(data)
+        return self._expected_separators, self._pending.append
+
+    def has_data(self) -> bool:
+        """Check if any rows were written to the csv file
 
-    def write(self):
-        with open(self.file_name, 'w') as f:
-            # write the header
-            f.write(','.join(self.columns) + '\n')
-            for d in self.data:
-                f.write(','.join(d) + '\n')
+        Returns:
+            bool: True if the csv file was created
+        """
+        return self._fh is not None
+
+    def append_shard(self, shard_path: str):
+        """Append the rows of a csv shard written by a worker process
+
+        Args:
+            shard_path (str): csv shard path
+        """
+        self.flush()
+        if self._fh is None:
+            self.__open()
+        with open(shard_path, 'rb') as shard:
+            shutil.copyfileobj(shard, self._fh, 1 << 20)
+
+    def flush(self):
+        """Write the pending rows to the csv file
+        """
+        if not self._pending:
+            return
+        if self._fh is None:
+            self.__open()
+        # the rows are joined into one buffer instead of appending a newline to every row
+        self._fh.write(b'\n'.join(self._pending))
+        self._fh.write(b'\n')
+        self._pending.clear()
+
+    def __open(self):
+        if self.header:
+            logger.debug('Creating output file: %s', self.file_name)
+        self._fh = open(self.file_name, 'wb', buffering=1 << 20)
+        if self.header:
+            self._fh.write((','.join(self.columns) + '\n').encode())
+
+    def close(self):
+        """Close the csv file and write the json datatype file. Nothing is written for a
+        message type without any rows
+        """
+        self.flush()
+        if self._fh is None or self._fh.closed:
+            return
+        self._fh.close()
+        if not self.header:
+            return
 
         # add a json type definition file
-        json_file = self.file_name.with_suffix('.json')
-        print("Creating JSON datatype file: ", json_file)
+        json_file = self.file_name[:-4] + '.json'
+        logger.debug('Creating JSON datatype file: %s', json_file)
         with open(json_file, 'w') as f:
-            # map the columns to the datatypes
-            column_datatype = dict(zip(self.columns, self.datatypes))
-            f.write(json.dumps(column_datatype, indent=4))
+            f.write(json.dumps(self._schema, indent=4))
 
 
 class LogParser:
     """Parse the .log file into separate files based on the format specified in the FMT messages
     """
 
-    def __init__(self, log_file_path: Path, output_dir: Path) -> None:
+    # smallest part of the log worth handing to a worker process
+    _MIN_CHUNK_SIZE = 16 << 20
+    # the pending rows of the output files are written every 2 ** 14 lines
+    _FLUSH_MASK = (1 << 14) - 1
+
+    def __init__(self, log_file_path: Path, output_dir: Path, jobs: int = 1,
+                 format_dict: Optional[Dict[str, LogFormat]] = None, shard: Optional[int] = None) -> None:
         """Initialize the LogParser object
 
         Args:
             log_file_path (Path): log file path
             output_dir (Path): output directory path
+            jobs (int, optional): number of processes parsing the data lines. Defaults to 1.
+            format_dict (Dict[str, LogFormat], optional): formats already read from the FMT
+                messages, given to a worker process. Defaults to None.
+            shard (int, optional): number of the csv shards written by a worker process,
+                instead of the output files. Defaults to None.
         """
         self.log_file_path = log_file_path
         self.output_dir = output_dir
+        # output paths are built by string formatting rather than through pathlib
+        self._out_dir_str = str(output_dir)
+        self.jobs = jobs
 
-        self.format_dict: Dict[str, LogFormat] = dict()
+        self.format_dict: Dict[str, LogFormat] = dict() if format_dict is None else format_dict
         self.output_csv: Dict[str, OutputFile] = dict()
 
+        # handlers for a line keyed by its first token; anything else is a data line
+        self._handlers: Dict[bytes, Callable[[bytes, int], None]] = {
+            b'FMT': self.__parse_format_line,
+        }
+        # OutputFile.get_row_writer() of every message type with an output file
+        self._row_writers: Dict[bytes, Tuple[int, Callable[[bytes], None]]] = dict()
+        # set in a worker process, which writes its rows to csv shards with this number
+        self._shard = shard
+
     def parse(self):
         """Parse the log file
         """
-        with open(self.log_file_path, 'r') as log_file:
-            for line_no, line in enumerate(log_file):
+        try:
+            # the log is memory mapped and read as bytes, only the FMT lines are decoded
+            with open(self.log_file_path, 'rb') as log_file:
+                size = os.fstat(log_file.fileno()).st_size
+                if size == 0:
+                    # an empty file can't be mapped and has nothing to parse
+                    return
+
+                with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+                    # first pass: read all the FMT messages so the data pass knows every format
+                    self.__read_formats(log_map)
+                    chunks = self.__split_chunks(log_map, size)
+
+            self._create_output_files()
+
+            # second pass: the data lines, split between worker processes for large logs
+            if len(chunks) == 1:
+                self._parse_range(*chunks[0])
+            else:
+                self.__parse_parallel(chunks)
+        except BaseException:
+            # don't leave the output files open if parsing fails
+            self.write_csv_files()
+            raise
+
+    def __read_formats(self, log_map: mmap.mmap):
+        line_no = 0
+        try:
+            for line_no, line in enumerate(iter(log_map.readline, b'')):
+                # stripped the same way as in the data pass
                 line = line.strip()
-                if not line:
-                    continue
-                
-                if line.startswith('FMT'):
-                    self.__parse_format_line(line, line_no)
-                else:
-                    self.__parse_data_line(line, line_no)
-
-    def __split_line(self, line: str):
-        return [t.strip() for t in line.split(', ')]
-
-    def __parse_format_line(self, line: str, line_no: int):
+                if line[:4] == b'FMT,':
+                    self.__read_format_line(self.__split_line(line))
+        except ValueError as e:
+            raise ValueError(f'Error on Line {line_no}. {e}') from e
+
+    def __split_chunks(self, log_map: mmap.mmap, size: int) -> List[Tuple[int, int]]:
+        jobs = max(1, min(self.jobs, size // self._MIN_CHUNK_SIZE))
+        bounds = [0]
+        for i in range(1, jobs):
+            # move the boundary to the start of the next line
+            newline = log_map.find(b'\n', size * i // jobs)
+            bound = size if newline < 0 else newline + 1
+            if bound > bounds[-1]:
+                bounds.append(bound)
+        if bounds[-1] < size:
+            bounds.append(size)
+
+        return list(zip(bounds, bounds[1:]))
+
+    def __parse_parallel(self, chunks: List[Tuple[int, int]]):
+        # every worker writes its own csv shards, which are appended to the output files in order
+        shard_dir = Path(tempfile.mkdtemp(dir=self.output_dir))
+        try:
+            with multiprocessing.Pool(len(chunks)) as pool:
+                shard_names = pool.starmap(_parse_chunk, [
+                    (self.log_file_path, shard_dir, self.format_dict, shard, start, end)
+                    for shard, (start, end) in enumerate(chunks)
+                ])
+
+            for shard, names in enumerate(shard_names):
+                for name in names:
+                    if name not in self.output_csv:
+                        # FMT lines that were handled as data lines
+                        self.__create_output_file(self.format_dict[name])
+                    self.output_csv[name].append_shard(f'{shard_dir}{os.sep}{name}.{shard}.csv')
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    def _parse_range(self, start: int, end: int):
+        """Parse the data lines in a part of the log file
+
+        Args:
+            start (int): offset of the first line to parse
+            end (int): offset just past the last line to parse
+        """
+        handlers = self._handlers
+        row_writers = self._row_writers
+        parse_data_line = self.__parse_data_line
+        flush_mask = self._FLUSH_MASK
+        separator = OutputFile.SEPARATOR
+        # the offset of a mapping has to be a multiple of the allocation granularity
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        line_no = 0
+        try:
+            with open(self.log_file_path, 'rb') as log_file, \
+                    mmap.mmap(log_file.fileno(), end - offset, access=mmap.ACCESS_READ, offset=offset) as log_map:
+                log_map.seek(start - offset)
+                # the line is only split into its name and the rest; the fields are checked
+                # and reformatted by bytes methods and the row is added to the output file
+                # without any python level call. Anything else, including rows with the
+                # wrong number of columns, goes through the handlers
+                for line_no, line in enumerate(iter(log_map.readline, b'')):
+                    if not line_no & flush_mask:
+                        self.__flush_output_files()
+
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    name, _, data = line.partition(separator)
+                    row_writer = row_writers.get(name)
+                    if row_writer is not None and line.count(separator) == row_writer[0]:
+                        row_writer[1](data.replace(separator, b','))
+                    else:
+                        handlers.get(name, parse_data_line)(line, line_no)
+        except ValueError as e:
+            raise ValueError(f'Error on Line {self.__count_lines(start) + line_no}. {e}') from e
+
+    def __flush_output_files(self):
+        for output_file in self.output_csv.values():
+            output_file.flush()
+
+    def __count_lines(self, end: int) -> int:
+        # number of lines before an offset, only needed to report errors
+        count = 0
+        with open(self.log_file_path, 'rb') as log_file:
+            while end > 0:
+                block = log_file.read(min(end, 1 << 20))
+                if not block:
+                    break
+                count += block.count(b'\n')
+                end -= len(block)
+        return count
+
+    def __split_line(self, line: bytes):
+        # fields are separated by ", " and the line itself is already stripped,
+        # so the tokens don't need to be stripped individually
+        return line.split(b', ')
+
+    def __read_format_line(self, parts: list):
         # FMT messages specifies the following format:
         # Type, Length, Name, Format, Columns
         # e.g.: FMT, 128, 89, FMT, BBnNZ, Type,Length,Name,Format,Columns
         # Note the columns are separated by commas with no spaces
 
-        parts = self.__split_line(line)
-        if len(parts) != 6 or not parts[0] == 'FMT':
-            # this could be a mis-classified data line
-            self.__parse_data_line(line, line_no)
+        if len(parts) != 6:
+            # this could be a mis-classified data line, handled in the data pass
             return
 
-        dt_type = parts[1]
-        dt_length = parts[2]
-        dt_name = parts[3]
-        dt_format = parts[4]
-        dt_columns = parts[5]
+        dt_type = parts[1].decode()
+        dt_length = parts[2].decode()
+        dt_name = parts[3].decode()
+        dt_format = parts[4].decode()
+        dt_columns = parts[5].decode()
 
         log_format = LogFormat(dt_type, dt_length, dt_name, dt_format, dt_columns)
 
-        self.format_dict[dt_name] = log_format
-
-    def __parse_data_line(self, line: str, line_no: int):
-        parts = self.__split_line(line)
-        name = parts[0]
-        if name not in self.format_dict:
-            print("Warning: Unknown format for line: ", line)
+        # all data lines of a message type are written to one csv, so a message type can
+        # only be defined again with the same columns. The first definition is kept
+        previous_format = self.format_dict.get(log_format.name)
+        if previous_format is not None:
+            if previous_format.columns != log_format.columns:
+                raise ValueError(f'Message {log_format.name} is redefined with different columns: '
+                                 f'{b", ".join(parts).decode()}')
+            if previous_format.datatypes != log_format.datatypes:
+                print("Warning: Keeping the first data types of redefined message: ",
+                      b", ".join(parts).decode())
             return
 
-        log_format = self.format_dict[name]
-        expected_columns = log_format.get_expected_column_count()
-        data = parts[1:]
+        self.format_dict[log_format.name] = log_format
 
-        if len(data) != expected_columns:
-            raise ValueError(f'Error on Line {line_no}. Expected {expected_columns} columns, got {len(data)}')
+    def __parse_format_line(self, line: bytes, line_no: int):
+        # FMT lines were already read in the first pass
+        if len(self.__split_line(line)) != 6:
+            # this could be a mis-classified data line
+            self.__parse_data_line(line, line_no)
+
+    def __parse_data_line(self, line: bytes, line_no: int):
+        raw_name = line.partition(OutputFile.SEPARATOR)[0]
+        log_format = self.format_dict.get(raw_name.decode(errors='replace'))
+        if log_format is None:
+            print("Warning: Unknown format for line: ", line.decode(errors='replace'))
+            return
 
-        if name not in self.output_csv:
-            print(f'Creating output file for {name}')
-            output_file_path = self.output_dir / Path(name).with_suffix('.csv')
-            columns = log_format.columns.copy()
-            datatypes = [log_format.format[c] for c in log_format.columns]            
-            self.output_csv[name] = OutputFile(columns, output_file_path, datatypes)
+        output_file = self.output_csv.get(log_format.name)
+        if output_file is None:
+            # only FMT lines handled as data lines don't have an output file yet
+            output_file = self.__create_output_file(log_format)
 
-        self.output_csv[name].add_data(data)
+        output_file.add_data(line)
+
+    def _create_output_files(self):
+        """Create the output file of every format read from the FMT messages, so the data
+        lines only have to look it up. The files themselves are only created once they have rows
+        """
+        for log_format in self.format_dict.values():
+            if log_format.name.encode() not in self._handlers:
+                self.__create_output_file(log_format)
+
+    def __create_output_file(self, log_format: LogFormat) -> OutputFile:
+        name = log_format.name
+        if self._shard is None:
+            output_file_path = f'{self._out_dir_str}{os.sep}{name}.csv'
+        else:
+            output_file_path = f'{self._out_dir_str}{os.sep}{name}.{self._shard}.csv'
+        output_file = OutputFile(log_format.columns, output_file_path, log_format.datatypes, header=self._shard is None)
+
+        self.output_csv[name] = output_file
+        if name.encode() not in self._handlers:
+            self._row_writers[name.encode()] = output_file.get_row_writer()
+        return output_file
 
     def write_csv_files(self) -> None:
-        """Write the output csv files
+        """Close the output csv files and write the json datatype files
         """
         for output_file in self.output_csv.values():
-            output_file.write()
+            output_file.close()
+
+
+def _parse_chunk(log_file_path: Path, shard_dir: Path, format_dict: Dict[str, LogFormat],
+                 shard: int, start: int, end: int) -> List[str]:
+    """Parse a part of the log file into csv shards, run in a worker process
+
+    Args:
+        log_file_path (Path): log file path
+        shard_dir (Path): directory to write the csv shards to
+        format_dict (Dict[str, LogFormat]): formats read from the FMT messages
+        shard (int): number of the shard, used in the shard file names
+        start (int): offset of the first line to parse
+        end (int): offset just past the last line to parse
+
+    Returns:
+        List[str]: names of the message types a shard with rows was written for
+    """
+    log_parser = LogParser(log_file_path, shard_dir, format_dict=format_dict, shard=shard)
+    try:
+        log_parser._create_output_files()
+        log_parser._parse_range(start, end)
+    finally:
+        log_parser.write_csv_files()
+
+    return [name for name, output_file in log_parser.output_csv.items() if output_file.has_data()]
 
 
 def main():
     parser = argparse.ArgumentParser(description='Parse ardupilot .log file into separate files')
     parser.add_argument('log_file', type=Path, help='Path to the .log file')
     parser.add_argument('output_dir', type=Path, help='Path to the output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes used to parse large log files (default: number of CPUs)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the output files as they are created')
 
     args = parser.parse_args()
     log_file_path: Path = args.log_file
     output_dir_path: Path = args.output_dir
 
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
+    if args.jobs < 1:
+        parser.error('The number of jobs must be at least 1')
+
     if not log_file_path.exists():
         parser.error(f'File {log_file_path} does not exist')
 
@@ -213,7 +528,7 @@ def main():
             exit(0)
 
 
-    log_parser = LogParser(log_file_path, output_dir_path)
+    log_parser = LogParser(log_file_path, output_dir_path, args.jobs)
     log_parser.parse()
     print("Parsing complete")
     log_parser.write_csv_files()